@@ -4,15 +4,35 @@ import random
 import time
 import html
 import datetime
+import math
+import threading
+import mmap
+import array
+import bisect
+import atexit
+import numpy as np
 from flask import Flask, request, jsonify
 
 app = Flask(__name__)
 
 # --- CONFIGURATION & GLOBALS ---
 DATA_FILE = "bankdaten_secure.json"
+LEDGER_FILE = "ledger.bin"
+LEDGER_FLUSH_INTERVAL = 1.0  # seconds between batched ledger appends
 MAX_CHAT_HISTORY = 30
 ONLINE_TIMEOUT = 120  # 2 minutes to be considered online
 
+# Crash round timing (seconds)
+CRASH_BET_PHASE = 8   # players can join the next round
+CRASH_PAUSE = 4       # crash result stays visible before the next round opens
+CRASH_GROWTH = 0.1    # multiplier = 1 + CRASH_GROWTH * t^2, same curve as the client
+CRASH_MAX = 500.0
+
+# Net worth history: one snapshot per interval, ring buffer of fixed length.
+# Kept in memory only, so it starts empty after every restart.
+PORTFOLIO_SNAPSHOT_INTERVAL = 60
+PORTFOLIO_HISTORY_LEN = 60
+
 # Game Constants
 JOBS = {
     "flaschensammler": {"name": "Flaschensammler", "req_level": 1, "salary": 10, "xp": 10, "cooldown": 10, "desc": "Mühsam nährt sich das Eichhörnchen."},
@@ -32,6 +52,11 @@ ITEMS = {
     "rolex": {"name": "Goldene Uhr", "price": 50000, "type": "cosmetic", "desc": "Zeigt Reichtum im Profil."}
 }
 
+# Ledger kinds, stored as their index. Only append new kinds at the end!
+LEDGER_KIND_NAMES = ["daily", "work", "crime", "shop_buy", "stock_buy", "stock_sell",
+                     "transfer_out", "transfer_in", "blackjack", "roulette", "crash"]
+LEDGER_KINDS = {k: i for i, k in enumerate(LEDGER_KIND_NAMES)}
+
 # Stocks definition
 STOCKS = {
     "PAU": {"name": "Pausenbrot AG", "price": 10.0, "volatility": 0.02, "trend": 0},
@@ -45,9 +70,14 @@ online_users = {} # name -> last_seen_timestamp
 
 # --- DATA MANAGEMENT ---
 class Database:
-    def __init__(self):
+    def __init__(self, ledger):
         self.filename = DATA_FILE
+        self.ledger = ledger
+        self.first_user_id = ledger.next_user_id() # ids below already have ledger history
         self.data = {"users": {}, "ips": {}}
+        self.touched = set() # users saved since the last net worth refresh
+        self.local = threading.local() # users looked up by the current thread
+        self.lock = threading.RLock() # serializes saves with batch updates like crash payouts
         self.load()
 
     def load(self):
@@ -60,12 +90,61 @@ class Database:
             except:
                 pass
 
+        # Numeric ids for the ledger, older data has none yet
+        for user in self.data["users"].values():
+            if "id" not in user: user["id"] = self.next_user_id()
+
+        # Pay back crash bets that never settled: the open round of a previous
+        # run and per-user games from before the shared rounds
+        refunded = False
+        for name, bet in self.data.pop("crash_bets", {}).items():
+            user = self.data["users"].get(name)
+            if user:
+                user["geld"] += bet
+                self.ledger.record(user, "crash", bet)
+                refunded = True
+        for user in self.data["users"].values():
+            game = user.pop("crash", None)
+            if game:
+                user["geld"] += game["bet"]
+                self.ledger.record(user, "crash", game["bet"])
+                refunded = True
+
+        if refunded: self.save()
+
+    def next_user_id(self):
+        uid = max(self.data.get("next_id", 0), self.first_user_id)
+        self.data["next_id"] = uid + 1
+        return uid
+
     def save(self):
-        with open(self.filename, "w") as f:
-            json.dump(self.data, f)
+        with self.lock:
+            # Whatever this thread looked up may have changed by now
+            self.touched |= self._lookups()
+            self.local.names = set()
+
+            # Other threads may change the data while we serialize it
+            for attempt in range(5):
+                try:
+                    dump = json.dumps(self.data)
+                    break
+                except RuntimeError:
+                    if attempt == 4: raise
+            # Write next to the old file first so a failed save never truncates it
+            tmp = self.filename + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(dump)
+            os.replace(tmp, self.filename)
+
+    def _lookups(self):
+        names = getattr(self.local, "names", None)
+        if names is None: names = self.local.names = set()
+        return names
 
     def get_user(self, name):
-        return self.data["users"].get(name)
+        user = self.data["users"].get(name)
+        if user is not None: self._lookups().add(name)
+        return user
 
     def create_user(self, name, pw, ip):
         if name in self.data["users"]:
@@ -73,6 +152,7 @@ class Database:
 
         # Initial user structure
         self.data["users"][name] = {
+            "id": self.next_user_id(),
             "passwort": pw,
             "geld": 100.0,
             "xp": 0,
@@ -83,14 +163,286 @@ class Database:
             "buffs": {}, # buff_name -> expire_time
             "stats": {"wins": 0, "games": 0},
             "daily_claimed": None, # date string
-            "blackjack": None,
-            "crash": None
+            "blackjack": None
         }
         self.data["ips"][ip] = name
+        self._lookups().add(name)
         self.save()
         return True, "User erstellt."
 
-db = Database()
+class NetWorthIndex:
+    # Keeps every user's assets as one row of a dense matrix:
+    # [cash | stock amounts per STOCKS symbol | item counts per ITEMS key].
+    # All net worths are then a single matrix-vector product with the value
+    # vector [1 | stock prices | item prices].
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.RLock() # requests and economy ticks share the matrices
+        self.symbols = list(STOCKS)
+        self.item_keys = list(ITEMS)
+        self.values = np.ones(1 + len(self.symbols) + len(self.item_keys))
+        self.values[1 + len(self.symbols):] = [ITEMS[k]["price"] for k in self.item_keys]
+
+        self.rows = {}  # name -> row
+        self.names = [] # row -> name
+        cap = max(1024, len(db.data["users"]))
+        self.assets = np.zeros((cap, len(self.values)))
+        self.networth = np.zeros(cap)
+        self.joined = np.zeros(cap, dtype=np.int64) # first snapshot that includes the user
+
+        self.history = np.zeros((cap, PORTFOLIO_HISTORY_LEN))
+        self.history_times = np.zeros(PORTFOLIO_HISTORY_LEN)
+        self.snapshots = 0
+        self.last_snapshot = 0.0
+        self.leaderboard = []
+
+        for name, user in db.data["users"].items():
+            self.sync(name, user)
+        self.update(time.time())
+
+    def _grow(self):
+        cap = len(self.networth) * 2
+        for attr in ("assets", "networth", "joined", "history"):
+            old = getattr(self, attr)
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+
+    def sync(self, name, user):
+        with self.lock:
+            row = self.rows.get(name)
+            if row is None:
+                row = len(self.names)
+                if row >= len(self.networth): self._grow()
+                self.rows[name] = row
+                self.names.append(name)
+                self.joined[row] = self.snapshots
+
+            stocks = user.get("stocks", {})
+            inv = user.get("inventory", {})
+            if isinstance(inv, list): inv = {}
+            self.assets[row, 0] = user["geld"]
+            self.assets[row, 1:1 + len(self.symbols)] = [stocks.get(s, 0) for s in self.symbols]
+            self.assets[row, 1 + len(self.symbols):] = [inv.get(k, 0) for k in self.item_keys]
+            return row
+
+    def refresh(self):
+        # Only rows of users that were saved since the last call are rebuilt
+        with self.db.lock:
+            touched, self.db.touched = self.db.touched, set()
+        users = self.db.data["users"]
+        for name in touched:
+            if name in users: self.sync(name, users[name])
+
+    def update(self, now):
+        # Called on every economy tick
+        with self.lock:
+            self.refresh()
+            self.values[1:1 + len(self.symbols)] = [STOCKS[s]["price"] for s in self.symbols]
+            n = len(self.names)
+            self.networth[:n] = self.assets[:n] @ self.values
+
+            if now - self.last_snapshot >= PORTFOLIO_SNAPSHOT_INTERVAL:
+                col = self.snapshots % PORTFOLIO_HISTORY_LEN
+                self.history[:n, col] = self.networth[:n]
+                self.history_times[col] = now
+                self.snapshots += 1
+                self.last_snapshot = now
+
+            # Top 10 without sorting everyone
+            k = min(10, n)
+            top = np.argpartition(-self.networth[:n], k - 1)[:k] if n > k else np.arange(n)
+            top = top[np.argsort(-self.networth[top], kind="stable")]
+            users = self.db.data["users"]
+            self.leaderboard = [
+                {"name": self.names[i], "geld": int(users[self.names[i]]["geld"]), "networth": int(self.networth[i]), "level": users[self.names[i]]["level"]}
+                for i in top
+            ]
+
+    def portfolio(self, name, user):
+        # Fresh valuation of a single user plus their snapshot history
+        with self.lock:
+            row = self.sync(name, user)
+            self.values[1:1 + len(self.symbols)] = [STOCKS[s]["price"] for s in self.symbols]
+            parts = self.assets[row] * self.values
+            split = 1 + len(self.symbols)
+
+            first = max(self.joined[row], self.snapshots - PORTFOLIO_HISTORY_LEN)
+            history = []
+            for snap in range(first, self.snapshots):
+                col = snap % PORTFOLIO_HISTORY_LEN
+                history.append({"time": int(self.history_times[col]), "networth": round(float(self.history[row, col]), 2)})
+
+            return {
+                "networth": round(float(parts.sum()), 2),
+                "cash": round(float(parts[0]), 2),
+                "stocks_value": round(float(parts[1:split].sum()), 2),
+                "items_value": round(float(parts[split:].sum()), 2),
+                "history": history
+            }
+
+# Fixed-size ledger record, 32 bytes: time, user id, kind, amount, balance after
+LEDGER_RECORD = np.dtype({
+    "names": ["time", "user", "kind", "amount", "balance"],
+    "formats": ["<f8", "<u4", "<u2", "<f8", "<f8"],
+    "offsets": [0, 8, 12, 16, 24],
+    "itemsize": 32
+})
+
+class Ledger:
+    # Append-only log of every money movement in a memory-mapped file.
+    # Requests only queue records, a writer thread appends them in batches.
+    # Header: magic (8 bytes) + record count (8 bytes), padded to one record.
+    MAGIC = b"LEDGER01"
+    HEADER = LEDGER_RECORD.itemsize
+    GROW = 1 << 20
+    SCAN_CHUNK = 1 << 20 # records per step when summing the file on start
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = []
+        self.lock = threading.Lock()    # guards pending
+        self.io_lock = threading.Lock() # guards file, mmap and index
+
+        if not os.path.exists(filename) or os.path.getsize(filename) < self.HEADER:
+            with open(filename, "wb") as f:
+                f.write(self.MAGIC + bytes(self.HEADER - len(self.MAGIC)))
+                f.truncate(self.HEADER + self.GROW)
+        self.f = open(filename, "r+b")
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        if self.mm[:8] != self.MAGIC:
+            raise ValueError(f"{filename} ist kein Ledger.")
+        self.count = int.from_bytes(self.mm[8:16], "little")
+
+        # Per-user index: user id -> record numbers, oldest first
+        self.index = {}
+        users = self._records()["user"]
+        order = np.argsort(users, kind="stable")
+        uids, starts = np.unique(users[order], return_index=True)
+        for uid, rows in zip(uids, np.split(order, starts[1:])):
+            self.index[int(uid)] = array.array("I", rows.astype(np.uint32).tobytes())
+        del users
+
+        # Running sums per day (days since epoch) and kind, kept up to date by flush()
+        self.daily = {}
+        for start in range(0, self.count, self.SCAN_CHUNK):
+            chunk = self._records()[start:start + self.SCAN_CHUNK]
+            self._add_daily(self.daily, chunk)
+            del chunk
+
+    def next_user_id(self):
+        # First id without any history, new users must never reuse one
+        return max(self.index) + 1 if self.index else 0
+
+    def _records(self):
+        return np.frombuffer(self.mm, dtype=LEDGER_RECORD, count=self.count, offset=self.HEADER)
+
+    @staticmethod
+    def _add_daily(sums, recs):
+        # Adds records into {day: amount per kind}
+        days = (recs["time"] // 86400).astype(np.int64)
+        day_keys, day_idx = np.unique(days, return_inverse=True)
+        part = np.zeros((len(day_keys), len(LEDGER_KIND_NAMES)))
+        np.add.at(part, (day_idx, recs["kind"].astype(np.int64)), recs["amount"])
+        for d, row in zip(day_keys, part):
+            d = int(d)
+            if d in sums: sums[d] += row
+            else: sums[d] = row
+
+    def record(self, user, kind, amount):
+        # Call after the balance was changed
+        with self.lock:
+            self.pending.append((time.time(), user["id"], LEDGER_KINDS[kind], amount, user["geld"]))
+
+    def flush(self):
+        # Queue swap and write happen under io_lock, so readers always see a
+        # record either in the file or in the queue
+        with self.io_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch: return
+
+            recs = np.array(batch, dtype=LEDGER_RECORD)
+            data = recs.tobytes()
+            start = self.HEADER + self.count * LEDGER_RECORD.itemsize
+            end = start + len(data)
+            if end > len(self.mm):
+                self.f.truncate(end + self.GROW)
+                # Old map is released once no query holds a view on it anymore
+                self.mm = mmap.mmap(self.f.fileno(), 0)
+            self.mm[start:end] = data
+
+            for i, entry in enumerate(batch):
+                self.index.setdefault(entry[1], array.array("I")).append(self.count + i)
+            self.count += len(batch)
+            self._add_daily(self.daily, recs)
+            # Count goes last, a crash mid-write only loses the batch
+            self.mm[8:16] = self.count.to_bytes(8, "little")
+
+    def _queued(self, uid=None):
+        # Records not written yet, call with io_lock held. Reads never flush,
+        # the writer thread stays the only one doing file I/O.
+        with self.lock:
+            batch = [e for e in self.pending if uid is None or e[1] == uid]
+        return np.array(batch, dtype=LEDGER_RECORD)
+
+    def history(self, uid, offset, limit):
+        # Newest first: queued records, then the file through the user's index
+        with self.io_lock:
+            queued = self._queued(uid)[::-1]
+            rows = self.index.get(uid, array.array("I"))
+            total = len(queued) + len(rows)
+
+            newest = queued[offset:offset + limit]
+            file_offset = max(0, offset - len(queued))
+            file_limit = limit - len(newest)
+            stop = max(0, len(rows) - file_offset)
+            picked = np.array(rows[max(0, stop - file_limit):stop], dtype=np.int64)[::-1]
+            recs = np.concatenate([newest, self._records()[picked]])
+
+        entries = [{
+            "time": float(r["time"]), "kind": LEDGER_KIND_NAMES[r["kind"]],
+            "amount": round(float(r["amount"]), 2), "balance": round(float(r["balance"]), 2)
+        } for r in recs]
+        return total, entries
+
+    def totals(self, since, uid=None):
+        # Sum per day and kind from the day `since` falls on. The whole economy
+        # comes from the running sums, a single user from their index: records
+        # are appended in time order, so a binary search skips everything older.
+        first_day = int(since // 86400)
+        if uid is None:
+            with self.io_lock:
+                sums = {d: row.copy() for d, row in self.daily.items() if d >= first_day}
+                queued = self._queued()
+            self._add_daily(sums, queued)
+        else:
+            with self.io_lock:
+                first = int(np.searchsorted(self._records()["time"], first_day * 86400))
+                # The user's record numbers are sorted, so only rows from
+                # `first` on are gathered
+                rows = self.index.get(uid, array.array("I"))
+                picked = np.array(rows[bisect.bisect_left(rows, first):], dtype=np.int64)
+                recs = np.concatenate([self._records()[picked], self._queued(uid)])
+            sums = {}
+            self._add_daily(sums, recs)
+
+        result = {}
+        for d in sorted(sums):
+            date = (datetime.date(1970, 1, 1) + datetime.timedelta(days=d)).isoformat()
+            result[date] = {LEDGER_KIND_NAMES[k]: round(float(v), 2) for k, v in enumerate(sums[d]) if v}
+        return result
+
+def ledger_writer():
+    while True:
+        time.sleep(LEDGER_FLUSH_INTERVAL)
+        ledger.flush()
+
+ledger = Ledger(LEDGER_FILE)
+db = Database(ledger)
+networth = NetWorthIndex(db)
+threading.Thread(target=ledger_writer, name="ledger-writer", daemon=True).start()
+atexit.register(ledger.flush)
 
 # --- HELPER FUNCTIONS ---
 def update_economy():
@@ -103,6 +455,7 @@ def update_economy():
             stock["price"] *= (1 + change)
             if stock["price"] < 1.0: stock["price"] = 1.0
         stock_last_update = now
+        networth.update(now)
 
 def check_levelup(user):
     # XP formula: Level L requires 100 * L^1.2 XP roughly
@@ -188,9 +541,8 @@ def get_data():
     # XP Progress for UI
     req_xp = int(100 * (user["level"] ** 1.2))
 
-    # Leaderboard (Top 10 Money)
-    sorted_users = sorted(db.data["users"].items(), key=lambda x: x[1]["geld"], reverse=True)[:10]
-    leaderboard = [{"name": k, "geld": int(v["geld"]), "level": v["level"]} for k,v in sorted_users]
+    # Leaderboard (Top 10 net worth, recomputed on each economy tick)
+    leaderboard = networth.leaderboard
 
     # Check Daily
     today_str = datetime.date.today().isoformat()
@@ -220,9 +572,61 @@ def get_data():
         "market": STOCKS,
         "chat": chat_history,
         "leaderboard": leaderboard,
+        "crash": crash_state(now),
         "online_count": active_users_count
     })
 
+@app.route('/api/portfolio', methods=['POST'])
+def portfolio():
+    name = request.json.get("name")
+    pw = request.json.get("pw")
+    user = db.get_user(name)
+
+    if not user or user["passwort"] != pw:
+        return jsonify({"ok": False})
+
+    # History is in-memory only (lost on restart), at most PORTFOLIO_HISTORY_LEN
+    # snapshots. Snapshots are taken on economy ticks, which only happen when
+    # requests come in, so quiet periods leave gaps.
+    update_economy()
+    return jsonify({
+        "ok": True,
+        "history_interval": PORTFOLIO_SNAPSHOT_INTERVAL,
+        "history_len": PORTFOLIO_HISTORY_LEN,
+        **networth.portfolio(name, user)
+    })
+
+@app.route('/api/ledger', methods=['POST'])
+def ledger_history():
+    name = request.json.get("name")
+    pw = request.json.get("pw")
+    user = db.get_user(name)
+
+    if not user or user["passwort"] != pw:
+        return jsonify({"ok": False})
+
+    page = max(0, int(request.json.get("page", 0)))
+    per_page = min(100, max(1, int(request.json.get("per_page", 20))))
+    total, entries = ledger.history(user["id"], page * per_page, per_page)
+    return jsonify({"ok": True, "total": total, "page": page, "per_page": per_page, "entries": entries})
+
+@app.route('/api/ledger/stats', methods=['POST'])
+def ledger_stats():
+    name = request.json.get("name")
+    pw = request.json.get("pw")
+    user = db.get_user(name)
+
+    if not user or user["passwort"] != pw:
+        return jsonify({"ok": False})
+
+    # Totals per source and day, own money ("me") or the whole economy ("all").
+    # Whole days, today included.
+    days = min(90, max(1, int(request.json.get("days", 7))))
+    scope = request.json.get("scope", "me")
+    since = (int(time.time() // 86400) - days + 1) * 86400
+    totals = ledger.totals(since, user["id"] if scope != "all" else None)
+    return jsonify({"ok": True, "days": totals})
+
 @app.route('/api/daily', methods=['POST'])
 def daily():
     name = request.json.get("name")
@@ -235,6 +639,7 @@ def daily():
 
     reward = 100 * user["level"]
     user["geld"] += reward
+    ledger.record(user, "daily", reward)
     user["daily_claimed"] = today_str
     db.save()
     return jsonify({"ok": True, "msg": f"Tagesbonus: +{reward}€ erhalten!", "reward": reward})
@@ -263,6 +668,7 @@ def work():
 
     # Success
     user["geld"] += job["salary"]
+    ledger.record(user, "work", job["salary"])
     user["xp"] += job["xp"]
     user["cooldowns"][f"work_{job_key}"] = time.time()
 
@@ -313,6 +719,7 @@ def crime():
 
     if random.random() < success_chance:
         user["geld"] += potential_win
+        ledger.record(user, "crime", potential_win)
         user["xp"] += 50
         lvl, _ = check_levelup(user)
         db.save()
@@ -322,6 +729,7 @@ def crime():
         user["cooldowns"]["jail_until"] = time.time() + jail_time
         loss = int(user["geld"] * 0.1)
         user["geld"] -= loss
+        ledger.record(user, "crime", -loss)
         db.save()
         return jsonify({"ok": True, "msg": f"ERWISCHT! {jail_time}s Knast & -{loss}€ Strafe.", "win": False})
 
@@ -340,6 +748,7 @@ def shop_buy():
 
     # Deduct money
     user["geld"] -= item["price"]
+    ledger.record(user, "shop_buy", -item["price"])
 
     # Add to inventory (dict)
     inv = user.setdefault("inventory", {})
@@ -410,6 +819,7 @@ def stock_trade():
         cost = current_price * amount
         if user["geld"] >= cost:
             user["geld"] -= cost
+            ledger.record(user, "stock_buy", -cost)
             user_stocks[symbol] = user_stocks.get(symbol, 0) + amount
             db.save()
             return jsonify({"ok": True, "msg": f"{amount} {symbol} gekauft."})
@@ -422,6 +832,7 @@ def stock_trade():
             user_stocks[symbol] -= amount
             if user_stocks[symbol] == 0: del user_stocks[symbol]
             user["geld"] += gain
+            ledger.record(user, "stock_sell", gain)
             db.save()
             return jsonify({"ok": True, "msg": f"{amount} {symbol} verkauft."})
         else:
@@ -467,6 +878,8 @@ def transfer():
 
     sender["geld"] -= amount
     receiver["geld"] += amount
+    ledger.record(sender, "transfer_out", -amount)
+    ledger.record(receiver, "transfer_in", amount)
     db.save()
     return jsonify({"ok": True, "msg": f"{amount}€ an {receiver_name} gesendet."})
 
@@ -503,6 +916,7 @@ def blackjack():
         if bet <= 0 or user["geld"] < bet: return jsonify({"ok": False, "msg": "Einsatz ungültig."})
 
         user["geld"] -= bet
+        ledger.record(user, "blackjack", -bet)
         deck = get_deck()
         player = [deck.pop(), deck.pop()]
         dealer = [deck.pop(), deck.pop()]
@@ -515,6 +929,7 @@ def blackjack():
         if calc_hand(player) == 21:
             win = bet * 2.5
             user["geld"] += win
+            ledger.record(user, "blackjack", win)
             user["blackjack"]["status"] = "win"
             user["blackjack"]["msg"] = "BLACKJACK! (x2.5)"
             state = user["blackjack"]
@@ -537,6 +952,7 @@ def blackjack():
             if user["geld"] < state["bet"]:
                 return jsonify({"ok": False, "msg": "Nicht genug Geld für Double."})
             user["geld"] -= state["bet"]
+            ledger.record(user, "blackjack", -state["bet"])
             state["bet"] *= 2
 
         state["player"].append(state["deck"].pop())
@@ -590,6 +1006,7 @@ def blackjack():
             state["msg"] = "Bank gewinnt."
 
         user["geld"] += win_amt
+        if win_amt: ledger.record(user, "blackjack", win_amt)
         user["stats"]["games"] += 1
         if win_amt > state["bet"]: user["stats"]["wins"] += 1
 
@@ -612,6 +1029,7 @@ def roulette():
         return jsonify({"ok": False, "msg": "Einsatz ungültig."})
 
     user["geld"] -= bet
+    ledger.record(user, "roulette", -bet)
     res = random.randint(0, 36)
 
     red_nums = [1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36]
@@ -639,15 +1057,112 @@ def roulette():
     if won:
         winnings = bet * multi
         user["geld"] += winnings
+        ledger.record(user, "roulette", winnings)
         msg = f"Kugel auf {res} ({color})! +{winnings}€"
 
     db.save()
     return jsonify({"ok": True, "result": res, "color": color, "winnings": winnings, "msg": msg})
 
+# --- CRASH ROUND ENGINE ---
+# One shared round for everybody. A background thread drives the phases
+# (betting -> running -> crashed), the multiplier is derived from the elapsed
+# time on the server and all cashouts are paid out in one batch at the end.
+crash_lock = threading.Lock()
+crash_round = {"id": 0, "phase": "crashed", "start_time": 0.0, "crash_point": 1.0, "crash_time": 0.0, "bets": {}, "cashouts": {}}
+
+def crash_multiplier(elapsed):
+    return 1.0 + CRASH_GROWTH * elapsed * elapsed
+
+def draw_crash_point():
+    # 3% house edge via instant crash at 1.00
+    if random.random() < 0.03:
+        return 1.00
+    # Pareto distribution
+    crash_p = 0.99 / (1.0 - random.random())
+    crash_p = min(crash_p, CRASH_MAX) # Cap
+    return max(crash_p, 1.0)
+
+def crash_state(now):
+    # Public view of the current round, the same for every player
+    with crash_lock:
+        r = crash_round
+        state = {"id": r["id"], "phase": r["phase"], "players": len(r["bets"])}
+        if r["phase"] == "betting":
+            state["starts_in"] = round(max(0.0, r["start_time"] - now), 1)
+        elif r["phase"] == "running":
+            state["elapsed"] = round(now - r["start_time"], 2)
+            state["multiplier"] = round(min(crash_multiplier(now - r["start_time"]), r["crash_point"]), 2)
+        else:
+            state["crash_point"] = round(r["crash_point"], 2)
+        return state
+
+def settle_crash_round(r):
+    # Batch payout for a finished round, one save for all players.
+    # The bets leave db.data["crash_bets"] in the same save that pays them out.
+    if not r["bets"]: return
+    with db.lock:
+        db.data["crash_bets"] = {}
+        for name, bet in r["bets"].items():
+            user = db.get_user(name)
+            if not user: continue
+            multi = r["cashouts"].get(name)
+            if multi is not None:
+                user["geld"] += int(bet * multi)
+                ledger.record(user, "crash", int(bet * multi))
+        db.save()
+
+def run_crash_round():
+    global crash_round
+    with crash_lock, db.lock:
+        # Bets still open here belong to a round that failed before settling
+        leftover = db.data.get("crash_bets", {})
+        for name, bet in leftover.items():
+            user = db.get_user(name)
+            if user:
+                user["geld"] += bet
+                ledger.record(user, "crash", bet)
+
+        # Open bets are stored with the users, so any save also saves the stakes
+        bets = {}
+        db.data["crash_bets"] = bets
+        crash_round = {
+            "id": crash_round["id"] + 1, "phase": "betting", "start_time": time.time() + CRASH_BET_PHASE,
+            "crash_point": None, "crash_time": None, "bets": bets, "cashouts": {}
+        }
+        if leftover: db.save()
+    time.sleep(CRASH_BET_PHASE)
+
+    # Crash point is only drawn once the bets are closed
+    with crash_lock:
+        crash_p = draw_crash_point()
+        crash_round["phase"] = "running"
+        crash_round["crash_point"] = crash_p
+        crash_round["start_time"] = time.time()
+        crash_round["crash_time"] = crash_round["start_time"] + math.sqrt((crash_p - 1.0) / CRASH_GROWTH)
+        crash_time = crash_round["crash_time"]
+    time.sleep(max(0.0, crash_time - time.time()))
+
+    with crash_lock:
+        crash_round["phase"] = "crashed"
+        finished = crash_round
+    settle_crash_round(finished)
+
+def crash_scheduler():
+    while True:
+        try:
+            run_crash_round()
+        except Exception:
+            # Keep the game running for everybody. Payouts that were applied
+            # are written by the next save, unsettled bets are refunded.
+            app.logger.exception("Crash round %s failed", crash_round["id"])
+        time.sleep(CRASH_PAUSE)
+
+threading.Thread(target=crash_scheduler, name="crash-scheduler", daemon=True).start()
+
 @app.route('/api/game/crash', methods=['POST'])
 def crash():
     name = request.json.get("name")
-    action = request.json.get("action")
+    action = request.json.get("action") # start, cashout, state
     user = db.get_user(name)
 
     if not user: return jsonify({"ok": False})
@@ -656,46 +1171,42 @@ def crash():
         bet = int(request.json.get("bet", 0))
         if bet <= 0 or user["geld"] < bet: return jsonify({"ok": False, "msg": "Geldproblem."})
 
-        user["geld"] -= bet
-
-        # Crash algo
-        # 3% house edge via instant crash at 1.00
-        if random.random() < 0.03:
-            crash_p = 1.00
-        else:
-            # Pareto distribution
-            crash_p = 0.99 / (1.0 - random.random())
-            crash_p = min(crash_p, 500.0) # Cap
-            if crash_p < 1.0: crash_p = 1.0
-
-        user["crash"] = {"bet": bet, "crash_point": crash_p, "start_time": time.time()}
-        db.save()
-        return jsonify({"ok": True})
+        with crash_lock, db.lock:
+            r = crash_round
+            if r["phase"] != "betting": return jsonify({"ok": False, "msg": "Runde läuft schon. Warte auf die nächste."})
+            if name in r["bets"]: return jsonify({"ok": False, "msg": "Du bist schon dabei."})
 
-    elif action == "cashout":
-        if not user.get("crash"): return jsonify({"ok": False, "msg": "Kein Spiel."})
-        g = user["crash"]
-
-        # We trust the client claims a multiplier <= Actual Crash Point?
-        # No, client sends "cashout" signal, we calculate current multiplier based on time elapsed?
-        # Better: Client sends the multiplier they saw.
-        # But for security, we should check time.
-        # Simplification: Trust client claim IF it is <= server_crash_point
-
-        claimed = float(request.json.get("multiplier", 1.0))
-        actual = g["crash_point"]
-
-        if claimed > actual:
-            # Lag or cheating: User crashed.
-            user["crash"] = None
+            # Stake and bet are saved together right away, payout comes with the round end
+            user["geld"] -= bet
+            ledger.record(user, "crash", -bet)
+            r["bets"][name] = bet
             db.save()
-            return jsonify({"ok": True, "win": False, "crash_point": actual, "msg": f"Crashed @ {actual:.2f}x"})
+            starts_in = max(0.0, r["start_time"] - time.time())
+            return jsonify({"ok": True, "round": r["id"], "starts_in": round(starts_in, 1), "msg": f"Einsatz {bet}€ platziert."})
 
-        win = int(g["bet"] * claimed)
-        user["geld"] += win
-        user["crash"] = None
-        db.save()
-        return jsonify({"ok": True, "win": True, "crash_point": actual, "winnings": win, "msg": f"Cashout @ {claimed}x"})
+    elif action == "cashout":
+        with crash_lock:
+            r = crash_round
+            now = time.time()
+            if name not in r["bets"] or name in r["cashouts"]: return jsonify({"ok": False, "msg": "Kein Spiel."})
+            if r["phase"] == "betting": return jsonify({"ok": False, "msg": "Runde hat noch nicht begonnen."})
+
+            if r["phase"] == "crashed" or now >= r["crash_time"]:
+                return jsonify({"ok": True, "win": False, "crash_point": r["crash_point"], "msg": f"Crashed @ {r['crash_point']:.2f}x"})
+
+            # Server time decides, rounded down so we never pay above the curve
+            multi = math.floor(crash_multiplier(now - r["start_time"]) * 100) / 100
+            r["cashouts"][name] = multi
+            win = int(r["bets"][name] * multi)
+            return jsonify({"ok": True, "win": True, "multiplier": multi, "winnings": win, "msg": f"Cashout @ {multi:.2f}x"})
+
+    elif action == "state":
+        state = crash_state(time.time())
+        with crash_lock:
+            if crash_round["id"] == state["id"]:
+                state["bet"] = crash_round["bets"].get(name)
+                state["cashout"] = crash_round["cashouts"].get(name)
+        return jsonify({"ok": True, "round": state})
 
     return jsonify({"ok": False})
 